@@ -1,12 +1,20 @@
 import sys
 import os
+import time
 
 __last_perc = -1
+__last_time = 0.0
 def progress_bar(message, value, endvalue, bar_length = 20):
-    global __lastWritten, __last_perc
+    global __lastWritten, __last_perc, __last_time
     ratio = float(value) / endvalue
     percent = int(round(ratio * 100))
     if percent == __last_perc: return
+
+    # Keep at least 50 ms between updates so a fast task does not spend its
+    # time redrawing the bar; the final update is always written
+    now = time.monotonic()
+    if percent != 100 and now - __last_time < 0.05: return
+    __last_time = now
     __last_perc = percent
 
     arrow = '-' * int(round(ratio * bar_length) - 1) + '>'
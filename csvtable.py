@@ -1,11 +1,24 @@
 import os
 import csv
+import shutil
+import string
+import console
+import threading
 from urllib import request
 from collections.abc import Mapping
 import _pickle as cPickle
+import msgpack
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
 
 cache_dir = 'cache'
 
+# Deletes every ascii character that is not a letter in a single C-level pass
+_non_letters_table = str.maketrans('', '', ''.join(
+    chr(char) for char in range(128) if chr(char) not in string.ascii_letters))
+
 """
 A read-only dictionary built after a given csv file. Implements all methods a read-only
 dictionary exposes, so use it as such.
@@ -36,8 +49,11 @@ class CsvTable(Mapping):
         self.filename = os.path.basename(source)
         self.filepath = os.path.join(cache_dir, self.filename)
         self.cached_filename = self.filename[:self.filename.rfind('.')] + \
-            '.obj'
+            '.msgpack'
         self.cached_filepath = os.path.join(cache_dir, self.cached_filename)
+        # Cache files from before the msgpack migration (kept for one release)
+        self.legacy_cached_filepath = os.path.join(
+            cache_dir, self.filename[:self.filename.rfind('.')] + '.obj')
         if not os.path.exists(cache_dir):
             os.mkdir(cache_dir)
         self.format = format
@@ -45,6 +61,8 @@ class CsvTable(Mapping):
         self.headers = headers
         self.key = key
         self.__table = dict()
+        self.__built = False
+        self.__build_lock = threading.Lock()
 
     def __make_local_copy(self):
         """
@@ -59,31 +77,112 @@ class CsvTable(Mapping):
         # Retrieve and save the file
         print("Retrieving file from " + self.source + "...")
         try:
-            # The source is a URL
-            request.urlretrieve(self.source, self.filepath)
+            # The source is a URL: stream it to disk in 1 MiB chunks
+            with request.urlopen(self.source) as response, \
+                    open(self.filepath, 'wb') as out_file:
+                total_size = int(response.headers.get('Content-Length') or 0)
+                read_size = 0
+                while True:
+                    chunk = response.read(1 << 20)
+                    if not chunk:
+                        break
+                    out_file.write(chunk)
+                    read_size += len(chunk)
+                    if total_size > 0:
+                        console.progress_bar("Downloading " + self.filename,
+                                             read_size, total_size)
             print("Downloaded and saved " + self.filename)
         except ValueError:
             # The source is a file path
-            os.copy(self.source, self.filepath)
+            shutil.copy(self.source, self.filepath)
 
     @staticmethod
     def __format_name(colname):
-        colname = colname.replace(' ', '_').lower()
-        return "".join([char for char in colname if char.isalpha()])
+        return colname.lower().translate(_non_letters_table)
 
     @staticmethod
     def __datum_as_type(dtype, datum):
         return None if datum == "" else dtype(datum)
 
+    def __parse_rows(self):
+        """
+        Parses the local csv file row by row with the stdlib csv module and
+        yields a dictionary of the data for each row.
+        """
+        with open(self.filepath, 'r') as csvfile:
+            reader = csv.reader(csvfile, delimiter=',', quotechar='\"')
+
+            # Parse the headers
+            if self.headers is None:
+                self.headers = [CsvTable.__format_name(colname) for colname in next(reader)]
+            else:
+                next(reader)
+
+            for row in reader:
+                data = [CsvTable.__datum_as_type(dtype, datum) for dtype, datum
+                        in zip(self.format, row)]
+                yield dict(zip(self.headers, data))
+
+    def __parse_rows_pandas(self):
+        """
+        Same as __parse_rows, but lets pandas' C parser tokenize and cast the
+        entire file at once instead of going cell by cell in Python.
+        """
+        # Read the headers separately so each column's dtype can be named
+        with open(self.filepath, 'r') as csvfile:
+            file_headers = next(csv.reader(csvfile, delimiter=',', quotechar='\"'))
+        if self.headers is None:
+            self.headers = [CsvTable.__format_name(colname) for colname in file_headers]
+
+        dtypes = {header: 'float64' if dtype is float else
+                          'Int64' if dtype is int else 'object'
+                  for header, dtype in zip(self.headers, self.format)}
+        frame = pd.read_csv(self.filepath, skiprows=1, names=self.headers,
+                            dtype=dtypes, keep_default_na=False,
+                            na_values=[""], low_memory=False)
+        for row in frame.itertuples(index=False, name=None):
+            yield {header: None if pd.isna(datum) else dtype(datum)
+                   for header, dtype, datum in
+                   zip(self.headers, self.format, row)}
+
     def build(self):
         """
         Effectively builds the table from the csv file if there is no cached
-        copy of it, otherwise the cached version is loaded.
+        copy of it, otherwise the cached version is loaded. Only the first
+        call does any work; this is safe to call from another thread.
         """
+        with self.__build_lock:
+            if self.__built:
+                return
+            self.__build()
+            self.__built = True
+
+    def prefetch(self):
+        """
+        Starts building the table in a background thread, so that the first
+        lookup finds it already built.
+        """
+        threading.Thread(target=self.build, daemon=True).start()
+
+    def __build(self):
         # Check if the table is not in cache first
         if os.path.exists(self.cached_filepath):
             print("Loading cached table" + self.cached_filename + "...")
             with open(self.cached_filepath, "rb") as cached_table:
+                raw_table = msgpack.unpackb(cached_table.read(), raw=False,
+                                            strict_map_key=False)
+            if self.entry_type is None:
+                self.__table = raw_table
+            else:
+                # Entries are stored as their raw row data, rebuild them
+                self.__table = {key: self.entry_type(named_data) for
+                                key, named_data in raw_table.items()}
+            return
+
+        # Fall back on caches from before the msgpack migration
+        if os.path.exists(self.legacy_cached_filepath):
+            print("Loading cached table" + self.cached_filename + "...")
+            with open(self.legacy_cached_filepath, "rb") as cached_table:
                 self.__table = cPickle.load(cached_table)
             return
 
@@ -93,41 +192,42 @@ class CsvTable(Mapping):
 
         # Build the table
         print("Parsing data from " + self.filename + "...")
-        with open(self.filepath, 'r') as csvfile:
-            reader = csv.reader(csvfile, delimiter=',', quotechar='\"')
+        rows = self.__parse_rows() if pd is None else self.__parse_rows_pandas()
 
-            # Parse the headers
-            if self.headers is None:
-                self.headers = [CsvTable.__format_name(colname) for colname in next(reader)]
+        # Create entries from the rows
+        raw_table = dict()
+        for i, named_data in enumerate(rows):
+            if self.entry_type is not None:
+                entry = self.entry_type(named_data)
             else:
-                next(reader)
+                entry = named_data
 
-            # Create entries from the rows
-            for i, row in enumerate(reader):
-                data = [CsvTable.__datum_as_type(dtype, datum) for dtype, datum
-                        in zip(self.format, row)]
-                named_data = dict(zip(self.headers, data))
+            if hasattr(entry, 'is_valid'):
+                if not entry.is_valid():
+                    continue
 
-                if self.entry_type is not None:
-                    entry = self.entry_type(named_data)
-                else:
-                    entry = named_data
+            key = i if self.key is None else self.key(entry)
+            self.__table[key] = entry
+            raw_table[key] = named_data
 
-                if hasattr(entry, 'is_valid'):
-                    if not entry.is_valid():
-                        continue
+        # Save the table in the disk cache. Entries are stored as their raw
+        # row data rather than as class instances, so that the cache remains
+        # msgpack-serializable.
+        with open(self.cached_filepath, "wb") as cached_table:
+            cached_table.write(msgpack.packb(raw_table, use_bin_type=True))
 
-                if self.key is None:
-                    self.__table[i] = entry
-                else:
-                    self.__table[self.key(entry)] = entry
+    def __getstate__(self):
+        # Locks cannot be pickled; one is recreated on load
+        state = self.__dict__.copy()
+        del state['_CsvTable__build_lock']
+        return state
 
-        # Save the table in the disk cache
-        with open(self.cached_filepath, "wb") as cached_table:
-            cPickle.dump(self.__table, cached_table)
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__build_lock = threading.Lock()
 
     def __getitem__(self, key):
-        if len(self.__table) == 0:
+        if not self.__built:
             self.build()
         return self.__table[key]
 
@@ -135,6 +235,6 @@ class CsvTable(Mapping):
         return len(self.__table)
 
     def __iter__(self):
-        if len(self.__table) == 0:
+        if not self.__built:
             self.build()
         return self.__table.__iter__()
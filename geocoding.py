@@ -1,8 +1,18 @@
-from urllib import request
+import os
 import json
+import hashlib
 import console
 import webbrowser
+import requests
 import shapely.geometry
+from shapely.prepared import prep
+
+geocoding_cache_dir = os.path.join('cache', 'geocoding')
+
+# A persistent session reuses the TCP connection across queries instead of paying a new
+# handshake for each one. Nominatim also requires a custom user agent.
+_session = requests.Session()
+_session.headers['User-Agent'] = 'WeatherCollector/1.0'
 
 # Documentation of the API can be found at:
 # http://wiki.openstreetmap.org/wiki/Nominatim
@@ -23,13 +33,35 @@ def query(search_string, interactive=False, result_count=5):
         location is always selected.
     result_count: int
         The limit in the number of locations considered. Only used in interactive mode.
+
+    Returns
+    -------
+    A (shape, prepared_shape) tuple, where <prepared_shape> is a prepared version of the
+    geometry against which point-in-polygon tests run much faster. None if no location
+    was found.
     """
 
-    # Retrieve guesses of location
-    search_string = search_string.replace(' ', '+')
-    url = "http://nominatim.openstreetmap.org/search?q=" + search_string + "&format=json&limit=" + \
-          str(result_count) + "&polygon_geojson=1"
-    page_data = request.urlopen(url).read().decode('ascii', 'ignore')
+    # Check the disk cache first: a hit saves a round trip and keeps repeated runs
+    # within Nominatim's fair-use policy
+    os.makedirs(geocoding_cache_dir, exist_ok=True)
+    cache_key = hashlib.sha256(search_string.encode()).hexdigest()[:16]
+    cached_filepath = os.path.join(geocoding_cache_dir, cache_key + '.json')
+    if os.path.exists(cached_filepath):
+        with open(cached_filepath) as cached_page:
+            page_data = cached_page.read()
+    else:
+        # Retrieve guesses of location
+        url = "http://nominatim.openstreetmap.org/search"
+        response = _session.get(url, params={'q': search_string, 'format': 'json',
+                                             'limit': result_count,
+                                             'polygon_geojson': 1})
+        # Only cache answers that are actual json, so a transient server error
+        # page does not poison the cache for this search string
+        response.raise_for_status()
+        page_data = response.text
+        json.loads(page_data)
+        with open(cached_filepath, 'w') as cached_page:
+            cached_page.write(page_data)
     if page_data == "[]":
         if interactive:
             print('Could not find anything for \"' + search_string + "\"")
@@ -68,4 +100,5 @@ def query(search_string, interactive=False, result_count=5):
         city = cities[0]
         print('Assuming ' + city["display_name"][:90])
 
-    return shapely.geometry.shape(city["geojson"])
\ No newline at end of file
+    shape = shapely.geometry.shape(city["geojson"])
+    return shape, prep(shape)
\ No newline at end of file
@@ -1,12 +1,19 @@
 import sys
 from record import Record
+from station import station_table
 import geocoding
 
 
 if __name__ == '__main__':
+    # Start building the station table in the background while the user fills the prompts
+    station_table.prefetch()
+
     print("Enter the name of the location to gather data from: ", end="")
     location_name = input().lower()
-    shape = geocoding.query(location_name, interactive=True)
+    result = geocoding.query(location_name, interactive=True)
+    if result is None:
+        sys.exit("No usable location, exiting.")
+    shape, prepared_shape = result
 
     print("Enter the start date (YYYYMMDD, e.g. 20160330): ", end="")
     start_date = input()
@@ -21,5 +28,5 @@ if __name__ == '__main__':
     max_stations = 12 if max_stations == "" else int(max_stations)
 
     record = Record(location_name, shape, start_date, end_date, contour_dist, max_stations,
-                    interactive=True)
+                    interactive=True, prepared_shape=prepared_shape)
     record.export_as_csv("weather_data_" + location_name + ".csv")
\ No newline at end of file
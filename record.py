@@ -1,19 +1,84 @@
 from station import Station
 from datetime import date, timedelta, datetime
+import csv
+import io
 import matplotlib.pyplot as plt
-import pathos.pools as pools
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import warnings
+import msgpack
+import os
 from os import path
 from google.cloud import bigquery
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+def _distance_weight(distance, max_distance):
+    if distance >= max_distance:
+        return 0.0
+    return 1.0 - (distance / max_distance) ** 2
+
+# Compile the scalar kernel when numba is around; it stays a plain function otherwise
+if njit is not None:
+    _distance_weight = njit(cache=True, fastmath=True)(_distance_weight)
+
+obs_cache_dir = os.path.join('cache', 'obs')
+
+def _retrieve_obs_cached(station, year):
+    """
+    Wraps Station.retrieve_obs with a per-(station, year) disk cache, so that records
+    overlapping an already collected period skip the network entirely. Observations of the
+    current year are never cached here, as they are still subject to change.
+    """
+    if year == datetime.now().year:
+        return station.retrieve_obs(year)
+
+    os.makedirs(obs_cache_dir, exist_ok=True)
+    cached_filepath = os.path.join(obs_cache_dir,
+                                   station.get_key() + ("_%d.msgpack" % year))
+    if os.path.exists(cached_filepath):
+        with open(cached_filepath, 'rb') as cached_obs:
+            packed = msgpack.unpackb(cached_obs.read(), raw=False, strict_map_key=False)
+        # Caches written before the columnar migration, including cached None
+        # results, are simply rebuilt below
+        if packed is not None and "dates" in packed:
+            vals = np.frombuffer(packed["vals"], dtype=np.float32)
+            return {"dates": packed["dates"],
+                    "vals": vals.reshape(-1, len(Station.obs_attributes))}
+
+    yearly_data = station.retrieve_obs(year)
+    # A None result is not cached: it can come from a transient server failure just
+    # as well as from a genuine 404, and caching it would blank the station-year
+    # forever
+    if yearly_data is None:
+        return None
+
+    # The value matrix is stored as its raw bytes, msgpack has no array type
+    packed = {"dates": yearly_data["dates"],
+              "vals": yearly_data["vals"].tobytes()}
+    with open(cached_filepath, 'wb') as cached_obs:
+        cached_obs.write(msgpack.packb(packed, use_bin_type=True))
+    return yearly_data
+
+def _obs_as_arrays(yearly_data):
+    """
+    Returns a station's yearly observations as a list of date keys plus a (n_days, n_attrs)
+    float array with NaN marking missing values, reordering the columns of the station data
+    to match Record.attributes. This keeps the weighted accumulation in Record.__build
+    fully vectorized.
+    """
+    column_indices = [Station.obs_attributes.index(attribute)
+                      for attribute in Record.attributes]
+    return yearly_data["dates"], yearly_data["vals"][:, column_indices]
 
 # Gathers weather data for a given location and time range
 class Record:
-    # IMPORTANT: multithreading on windows requires code to be inside of
-    #   if __name__ == '__main__':
-    #       ...
-    # otherwise it will recursively run the entire code
-    multithreaded = True    
+    # Station data is fetched over the network, so worker threads spend their time waiting
+    # on I/O with the GIL released. Threads also avoid the process-fork pitfalls a process
+    # pool would bring on windows.
+    multithreaded = True
     date_format = "%Y%m%d"  # YYYYMMDD
     attributes = ['min',        # Min temperature F°
                   'temp',       # Mean temperature F°
@@ -36,7 +101,7 @@ class Record:
     max_station_distance = 50.0 # Distance in km after which a station has no weight
     
     def __init__(self, name, shape, start_date, end_date=None, contour_dist=25, max_stations=12,
-                 interactive=False, save_plot=False):
+                 interactive=False, save_plot=False, prepared_shape=None):
         """
         :param name: The name of the location
         :param shape: The (multi)polygon describing the shape of the location
@@ -46,9 +111,12 @@ class Record:
         :param max_stations: Maximum number of stations used to gather data
         :param interactive: Whether or not to display a plot of the stations
         :param save_plot: Whether or not to save this plot to disk
+        :param prepared_shape: A prepared version of <shape> (shapely.prepared), speeding up
+        the station containment tests
         """
         self.name = name
         self.shape = shape
+        self.prepared_shape = prepared_shape
         self.contour_dist = contour_dist
         if contour_dist > Record.max_station_distance:
             warnings.warn('contour distance of %f is greater than maximum allowed distance of %f' %
@@ -63,14 +131,14 @@ class Record:
         self.save_plot = save_plot
         
         # Gather the data and build the record
-        self.collection_info = ""
+        self._log_lines = []
         self.__build()
-    
+
     def __log(self, message):
-        self.collection_info += "# " + message.replace("\n", "\n# ") + "\n"
+        self._log_lines.extend("# " + line for line in message.split("\n"))
     
     def __plot_stations(self, closest_stations):
-        shapes = self.shape if self.shape.geom_type == 'MultiPolygon' else [self.shape]
+        shapes = self.shape.geoms if self.shape.geom_type == 'MultiPolygon' else [self.shape]
         for sub_shape in shapes:
             x, y = sub_shape.exterior.xy
             plt.plot(x, y, c='blue')
@@ -102,7 +170,8 @@ class Record:
             self.shape,
             self.contour_dist,
             self.start_date,
-            self.end_date
+            self.end_date,
+            prepared=self.prepared_shape
         )
     
         if len(closest_stations) == 0:
@@ -118,8 +187,7 @@ class Record:
         
         # Display them
         self.__log("STATIONS:")
-        base_weights = [Record.distance_weight(distance) for distance in distances]
-        base_weights = np.array(base_weights)
+        base_weights = Record.distance_weights(distances)
         for (station, distance), weight in zip(closest_stations, base_weights):
             message = station.name[:20].ljust(20) + (" at %.2fkm" % distance).ljust(14) + \
                       "(trust: %.2f%%)" % (weight * 100)
@@ -128,60 +196,66 @@ class Record:
         if self.interactive or self.save_plot:
             self.__plot_stations(closest_stations)
             
-        # Gather data
-        self.data = []
+        # Gather data, keeping the same thread pool alive across years
         if Record.multithreaded:
-            thread_pool = pools.ProcessPool(4)
-        date = self.start_date
-        year = -1
-        while date <= self.end_date:
-            if year != date.year:
-                # Retrieve data from the year <year> for each station
-                year = date.year
-                print("\nCollecting data for the year %d" % year)
-                if Record.multithreaded:
-                    job = lambda station: station.retrieve_obs(year)
-                    all_yearly_data = thread_pool.map(job, stations)
-                else:
-                    all_yearly_data = [station.retrieve_obs(year) for station in stations]
-            
-            # Gather daily data
-            date_key = date.strftime(Record.date_format)
-            daily_data, daily_trusts = [], []
-            for yearly_data, trust in zip(all_yearly_data, base_weights):
+            thread_pool = ThreadPoolExecutor(max_workers=min(16, len(stations)))
+        n_days = (self.end_date - self.start_date).days + 1
+        n_attrs = len(Record.attributes)
+        dates = [self.start_date + timedelta(days=i) for i in range(n_days)]
+        date_to_idx = {Record.__date_key(d): i for i, d in enumerate(dates)}
+
+        # Accumulate each station's weighted contributions into (n_days, n_attrs) sums,
+        # walking every station's yearly data only once
+        sum_vals = np.zeros((n_days, n_attrs))
+        sum_weights = np.zeros_like(sum_vals)
+        day_has_data = np.zeros(n_days, dtype=bool)
+        for year in range(self.start_date.year, self.end_date.year + 1):
+            # Retrieve data from the year <year> for each station
+            print("\nCollecting data for the year %d" % year)
+            if Record.multithreaded:
+                job = lambda station: _retrieve_obs_cached(station, year)
+                all_yearly_data = list(thread_pool.map(job, stations))
+            else:
+                all_yearly_data = [_retrieve_obs_cached(station, year) for station in stations]
+
+            for yearly_data, weight in zip(all_yearly_data, base_weights):
                 if yearly_data is None:
                     continue
-                if date_key in yearly_data:
-                    daily_data.append(yearly_data[date_key])
-                    daily_trusts.append(trust)
-                    
-            # Case of missing data for the entire day
-            if len(daily_data) == 0:
-                print("Got no data for " + str(date))
-                
-            # Populate attributes
-            datum = {}
-            for attribute in Record.attributes:
-                # Perform a weighted average
-                value = 0
-                total_weight = 0
-                for daily_datum, daily_trust in zip(daily_data, daily_trusts):
-                    if daily_datum[attribute] is None:
-                        continue
-                    value += daily_datum[attribute] * daily_trust
-                    total_weight += daily_trust
-                    
-                if total_weight == 0:
-                    datum[attribute] = None
+                date_keys, vals = _obs_as_arrays(yearly_data)
+                day_idx = np.array([date_to_idx.get(date_key, -1) for date_key in date_keys])
+                in_range = day_idx >= 0
+                if not in_range.any():
                     continue
+                day_idx = day_idx[in_range]
+                vals = vals[in_range]
 
-                value = value / total_weight
-                datum[attribute] = value
-            
-            # Add datum to record
+                present = ~np.isnan(vals)
+                np.add.at(sum_vals, day_idx, np.where(present, vals, 0) * weight)
+                np.add.at(sum_weights, day_idx, present * weight)
+                day_has_data[day_idx] = True
+        if Record.multithreaded:
+            thread_pool.shutdown()
+
+        # Perform the weighted average in one vectorized pass
+        averages = sum_vals / np.where(sum_weights == 0, 1, sum_weights)
+
+        # Assemble the record, reporting days with no data at all
+        self.data = []
+        for day_idx, date in enumerate(dates):
+            if not day_has_data[day_idx]:
+                print("Got no data for " + str(date))
+            datum = {attribute: None if sum_weights[day_idx, attr_idx] == 0
+                     else averages[day_idx, attr_idx]
+                     for attr_idx, attribute in enumerate(Record.attributes)}
             self.data.append((date, datum))
-            
-            date += timedelta(days=1)
+
+    @staticmethod
+    def __date_key(date):
+        """
+        Equivalent to date.strftime(Record.date_format), without strftime's per-call
+        format parsing and locale lookup.
+        """
+        return "%04d%02d%02d" % (date.year, date.month, date.day)
 
     @staticmethod
     def distance_weight(distance):
@@ -192,43 +266,58 @@ class Record:
         :return: [float] The coefficient of trust (within [0 - 1])
         """
         # A plot of the function can be found here: https://i.imgur.com/QjzAT18.png
-        if distance >= Record.max_station_distance:
-            return 0
-        return 1 - (distance / Record.max_station_distance) ** 2
-    
-    def export_as_csv(self, filepath):
-        just_size = 11
-        csvfile = open(filepath, 'w')
-        
+        return _distance_weight(distance, Record.max_station_distance)
+
+    @staticmethod
+    def distance_weights(distances):
+        """
+        Vectorized version of distance_weight.
+        :param distances: [array of float] The distances in kilometers
+        :return: [array of float] The coefficients of trust (within [0 - 1])
+        """
+        distances = np.asarray(distances, dtype=np.float64)
+        return np.where(distances >= Record.max_station_distance, 0,
+                        1 - (distances / Record.max_station_distance) ** 2)
+
+    def export_as_csv(self, filepath, pretty=False):
+        """
+        :param filepath: Destination path of the csv file
+        :param pretty: Whether to pad the columns for human inspection. This produces
+        larger files and is slower to write.
+        """
+        just_size = 11 if pretty else 0
+        buffer = io.StringIO()
+        # Keep the baseline's LF endings, csv.writer defaults to CRLF
+        writer = csv.writer(buffer, lineterminator='\n')
+
         # Write the header
-        csvfile.write(self.collection_info + "\n")
-        csvfile.write("DATE,".ljust(just_size))
-        for attribute in Record.attributes:
-            attribute = attribute.upper() + ("," if attribute != Record.attributes[-1] else "") 
-            csvfile.write(attribute.ljust(just_size))
-        csvfile.write("\n")
-        
+        buffer.write("\n".join(self._log_lines) + "\n\n")
+        header = ["DATE"] + [attribute.upper() for attribute in Record.attributes]
+        if pretty:
+            buffer.write("".join((column + ",").ljust(just_size) for
+                                 column in header[:-1]) + header[-1].ljust(just_size) + "\n")
+        else:
+            writer.writerow(header)
+
         # Write each row
         for date, datum in self.data:
-            csvfile.write((date.strftime(Record.date_format)+ ", ").ljust(just_size))
-            
+            row = [Record.__date_key(date)]
             for attribute in Record.attributes:
                 if not attribute in datum:
                     raise Exception('Corrupted record data')
-                
-                if datum[attribute] is None:
-                    text = "NA"
-                else:
-                    text = "%.3f" % datum[attribute]
-                    
-                if attribute != Record.attributes[-1]:
-                    text += ", "
-                    
-                csvfile.write(text.ljust(just_size))
-            csvfile.write("\n")
-            
+                row.append("NA" if datum[attribute] is None else "%.3f" % datum[attribute])
+
+            if pretty:
+                buffer.write("".join((text + ", ").ljust(just_size) for
+                                     text in row[:-1]) + row[-1].ljust(just_size) + "\n")
+            else:
+                writer.writerow(row)
+
+        # Dump the whole buffer in a single write
+        with open(filepath, 'w', newline='') as csvfile:
+            csvfile.write(buffer.getvalue())
+
         print("\nSuccesfully written " + filepath + "!")
-        csvfile.close()
         
     def export_in_bigquerry(self):
         access_key = path.realpath("../../access_key.json")
@@ -247,14 +336,15 @@ class Record:
                 if not attribute in datum:
                     raise Exception("Corrupted record data")
 
-                if datum[attribute] is None:
-                    entry[attribute] = None 
-                else:
-                    entry[attribute] = "%.3f" % datum[attribute]
-            
+                # Send floats as floats, BigQuery accepts None for nulls
+                entry[attribute] = datum[attribute]
+
             data.append(entry)
 
-        result = bigquery_client.create_rows(table_ref, data)
+        # Insert in batches of 500 rows, the size the client documents as optimal
+        result = []
+        for batch_start in range(0, len(data), 500):
+            result += bigquery_client.create_rows(table_ref, data[batch_start:batch_start + 500])
         if  result != []:
             print("Error storing weather")
             print(result)